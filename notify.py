@@ -1,21 +1,39 @@
-"""Run notify-send whenever given amount of hours of work is reached"""
+"""Send a desktop notification whenever given amount of hours of work is reached"""
 
 import argparse
 import subprocess
 import temps
 
+try:
+    import dbus
+except ImportError:  # fallback on notify-send
+    dbus = None
+
+
 def parse_cli():
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('--hours-per-day', type=float, help="how many hours you should work per day to reach your total workload", default=7.4)
     return parser.parse_args()
 
 
+def notify(summary:str):
+    "Send given summary to the notification daemon, through D-Bus if available"
+    if dbus is not None:
+        try:
+            bus = dbus.SessionBus()
+            notifier = bus.get_object('org.freedesktop.Notifications', '/org/freedesktop/Notifications')
+            iface = dbus.Interface(notifier, 'org.freedesktop.Notifications')
+            iface.Notify('pointeuse', 0, '', summary, '', [], {}, -1)
+            return
+        except dbus.exceptions.DBusException:  # no session bus reachable
+            pass
+    subprocess.Popen(['notify-send', summary])
+
+
 if __name__ == '__main__':
     args = parse_cli()
     stats = temps.run('stats', hours_per_day=args.hours_per_day)
     if stats['total_difftime'] > 10:
-        sup = temps.minutes_to_hr(stats['total_difftime'])
-        subprocess.Popen(['notify-send', f'OVERWORK: {sup}'])
-    if stats['total_difftime'] < 10:
-        sup = temps.minutes_to_hr(-stats['total_difftime'])
-        subprocess.Popen(['notify-send', f'WORK NEEDED: {sup}'])
+        notify(f"OVERWORK: {temps.minutes_to_hr(stats['total_difftime'])}")
+    elif stats['total_difftime'] < 10:
+        notify(f"WORK NEEDED: {temps.minutes_to_hr(-stats['total_difftime'])}")
@@ -3,12 +3,20 @@
 
 """
 
+import os
+import re
+import mmap
+import struct
 import argparse
 import datetime
-import csv
+import functools
 from collections import defaultdict
 
 ACTIONS = 'arrive', 'quit', 'stats'
+ROW_REGEX = re.compile(rb'^([^,\r\n]+),([^,\r\n]*),([^,\r\n]*)\r?$', re.MULTILINE)
+BINARY_HEADER = struct.Struct('<qQQ')  # mtime in ns and size of the copied file, number of records
+BINARY_RECORD = struct.Struct('<IHH')  # date ordinal, start and stop minutes
+BINARY_UNFINISHED = 0xFFFF  # stop minutes of an unfinished entry
 
 
 def parse_cli():
@@ -20,16 +28,36 @@ def parse_cli():
     parser.add_argument('--hours-per-day', type=float, help="how many hours you should work per day to reach your total workload", default=None)
     parser.add_argument('--not-today', '-n', action='store_true', help="don't consider today in stats")
     parser.add_argument('--timefile', '-f', type=str, default='./temps', help="The file containing the times")
+    parser.add_argument('--binary-cache', '-b', action='store_true', help="load the times from a binary copy of the timefile, kept up to date next to it")
     return parser.parse_args()
 
 
 class Entry:
+    __slots__ = ('_date_base', '_time_start', 'time_stop', '_hr_date', '_hr_start')
 
     def __init__(self, date_base, time_start, time_stop):
         self.date_base = date_base
         self.time_start = time_start
         self.time_stop = time_stop
 
+    @property
+    def date_base(self) -> datetime.date:
+        return self._date_base
+
+    @date_base.setter
+    def date_base(self, value:datetime.date):
+        self._date_base = value
+        self._hr_date = None  # formatted on first access
+
+    @property
+    def time_start(self) -> datetime.time:
+        return self._time_start
+
+    @time_start.setter
+    def time_start(self, value:datetime.time):
+        self._time_start = value
+        self._hr_start = None  # formatted on first access
+
     def __str__(self) -> str:
         return ' '.join(tuple(self))
 
@@ -39,43 +67,53 @@ class Entry:
     @property
     def hr_date(self) -> str:
         "Human readable date"
-        return self.date_base.strftime("%y/%m/%d")
+        if self._hr_date is None:
+            self._hr_date = self.date_base.strftime("%y/%m/%d")
+        return self._hr_date
 
     @property
     def hr_start(self) -> str:
         "Human readable time"
-        return self.time_start.strftime("%Hh%M")
+        if self._hr_start is None:
+            self._hr_start = self.time_start.strftime("%Hh%M")
+        return self._hr_start
 
     @property
     def hr_stop(self) -> str:
         "Human readable time"
         return '' if self.is_unfinished() else self.time_stop.strftime("%Hh%M")
 
-    @property
-    def working_time(self) -> datetime.time:
-        "describe how much work time was produced"
+    def working_minutes(self, now_minutes:int=None) -> int:
+        "describe how much work time was produced, in minutes, an unfinished entry stopping at now_minutes"
         start = self.time_start.hour * 60 + self.time_start.minute
         if self.is_unfinished():
-            now = datetime_time_from_now()
-            stop = now.hour * 60 + now.minute
+            if now_minutes is None:
+                now = datetime.datetime.now()
+                now_minutes = now.hour * 60 + now.minute
+            stop = now_minutes
         else:
             stop = self.time_stop.hour * 60 + self.time_stop.minute
-        working_time = stop - start
-        return datetime.time(hour=working_time // 60, minute=working_time % 60)
+        return stop - start
+
+    @property
+    def working_time(self) -> datetime.time:
+        "describe how much work time was produced"
+        hour, minute = divmod(self.working_minutes(), 60)
+        return datetime.time(hour=hour, minute=minute)
 
     def is_unfinished(self) -> bool:
         return self.time_stop is None
 
-    def is_today(self) -> bool:
-        return self.hr_date == date_from_now()
+    def is_today(self, today:datetime.date=None) -> bool:
+        return self.date_base == (today or datetime.date.today())
 
-    def set_finish_now(self):
+    def set_finish_now(self, now:datetime.datetime=None):
         assert self.is_unfinished(), self
-        self.time_stop = datetime_time_from_now()
+        self.time_stop = datetime_time_from_now(now)
 
-    def set_start_now(self):
+    def set_start_now(self, now:datetime.datetime=None):
         assert self.is_unfinished(), self
-        self.time_start = datetime_time_from_now()
+        self.time_start = datetime_time_from_now(now)
 
 
     @staticmethod
@@ -89,133 +127,186 @@ class Entry:
         return Entry(date, date_start, date_stop)
 
     @staticmethod
-    def now_arrived():
-        return Entry.from_tuple(date_from_now(), time_from_now(), None)
+    def now_arrived(now:datetime.datetime=None):
+        now = now or datetime.datetime.now()
+        return Entry(now.date(), datetime_time_from_now(now), None)
 
 
 def datetime_from_date_and_time(date:datetime.date, time:datetime.time) -> datetime.datetime:
     return datetime.datetime(year=date.year, month=date.month, day=date.day, hour=time.hour, minute=time.minute)
 
-def date_from_now() -> str:
-    return datetime.datetime.now().strftime("%y/%m/%d")
-
-def time_from_now() -> str:
-    return datetime.datetime.now().strftime("%Hh%M")
-
-def datetime_time_from_now() -> datetime.time:
-    now = datetime.datetime.now()
+def datetime_time_from_now(now:datetime.datetime=None) -> datetime.time:
+    now = now or datetime.datetime.now()
     return datetime.time(hour=now.hour, minute=now.minute)
 
+@functools.lru_cache(maxsize=4096)
 def datetime_time_from_hour(hour:str) -> datetime.time:
     if hour is None: return None
     _ = datetime.datetime.strptime(hour, "%Hh" if hour.endswith('h') else "%Hh%M")
     return datetime.time(_.hour, _.minute)
 
+@functools.lru_cache(maxsize=4096)
 def datetime_date_from_date(date:str) -> datetime.date:
     _ = datetime.datetime.strptime(date, "%y/%m/%d")
     return datetime.date(_.year, _.month, _.day)
 
 
 def get_data(fname:str='temps'):
-    with open(fname) as fd:
-        reader = csv.reader(fd, delimiter=',')
-        for date, start, stop in reader:
+    with open(fname, 'rb') as fd:
+        try:
+            buf = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty file cannot be mapped
+            return
+    with buf:
+        end = 0  # end of the previous row
+        for match in ROW_REGEX.finditer(buf):
+            if buf[end:match.start()] != (b'\n' if end else b''):  # skipped something
+                raise_invalid_row(fname, buf, end + 1 if end else 0)
+            end = match.end()
+            date, start, stop = (field.decode() for field in match.groups())
             yield Entry.from_tuple(date, start, stop)
+        trailing = buf[end:]
+        if trailing.strip():
+            raise_invalid_row(fname, buf, end + len(trailing) - len(trailing.lstrip()))
+
+def raise_invalid_row(fname:str, buf:bytes, start:int):
+    "Raise ValueError describing the line beginning at given position"
+    stop = buf.find(b'\n', start)
+    line = buf[start:len(buf) if stop == -1 else stop].decode(errors='replace')
+    lineno = buf[:start].count(b'\n') + 1
+    raise ValueError(f"{fname}:{lineno}: invalid row {line!r}, expected 'yy/mm/dd,HHhMM,HHhMM'")
 
 def set_data(entries:[Entry], fname:str='temps'):
-    with open(fname, 'w') as fd:
-        for entry in entries:
-            writer = csv.writer(fd, delimiter=',')
-            writer.writerow(tuple(entry))
+    with open(fname, 'w', newline='') as fd:
+        fd.writelines(map(entry_as_line, entries))
 
 def add_data(entry:Entry, fname:str='temps'):
-    with open(fname, 'a') as fd:
-        writer = csv.writer(fd, delimiter=',')
-        writer.writerow(tuple(entry))
+    with open(fname, 'a', newline='') as fd:
+        fd.write(entry_as_line(entry))
+
+def entry_as_line(entry:Entry) -> str:
+    "No field can contain a comma or a quote, so no need for csv escaping"
+    return f"{entry.hr_date},{entry.hr_start},{entry.hr_stop}\r\n"  # same line terminator as csv.writer
+
+
+def get_data_cached(fname:str='temps', update:bool=True) -> [Entry]:
+    "Like get_data, but through a binary copy of the file, rebuilt (if update) when it does not match the file anymore"
+    binfile = fname + '.bin'
+    stat = os.stat(fname)
+    source = stat.st_mtime_ns, stat.st_size
+    entries = get_binary_data(binfile, source)
+    if entries is None:
+        entries = list(get_data(fname))
+        if update:
+            set_binary_data(entries, source, binfile)
+    return entries
+
+def get_binary_data(fname:str='temps.bin', source:(int, int)=None) -> [Entry] or None:
+    """Return entries of given binary file, or None if it is missing, truncated,
+    or was not copied from given source (mtime in ns, size)"""
+    if not os.path.exists(fname):
+        return None
+    with open(fname, 'rb') as fd:
+        data = fd.read()
+    if len(data) < BINARY_HEADER.size:
+        return None
+    mtime_ns, size, count = BINARY_HEADER.unpack_from(data)
+    if source is not None and (mtime_ns, size) != tuple(source):
+        return None
+    if len(data) != BINARY_HEADER.size + count * BINARY_RECORD.size:
+        return None
+    entries = []
+    for date, start, stop in BINARY_RECORD.iter_unpack(memoryview(data)[BINARY_HEADER.size:]):
+        stop = None if stop == BINARY_UNFINISHED else datetime.time(stop // 60, stop % 60)
+        entries.append(Entry(datetime.date.fromordinal(date), datetime.time(start // 60, start % 60), stop))
+    return entries
 
+def set_binary_data(entries:[Entry], source:(int, int), fname:str='temps.bin'):
+    "Write given entries copied from given source (mtime in ns, size) into given binary file"
+    tmpfile = fname + '.tmp'  # replaced at once, so an interrupted write never leaves a partial cache
+    with open(tmpfile, 'wb') as fd:
+        fd.write(BINARY_HEADER.pack(*source, len(entries)))
+        for entry in entries:
+            stop = BINARY_UNFINISHED if entry.is_unfinished() else datetime_time_to_minutes(entry.time_stop)
+            fd.write(BINARY_RECORD.pack(entry.date_base.toordinal(), datetime_time_to_minutes(entry.time_start), stop))
+    os.replace(tmpfile, fname)
 
 
 def run(action, entries:[Entry]=None, overwrite:bool=False, dry_run:bool=False, hours_per_day:float=7.4, porcelain:bool=False, include_today:bool=True) -> str or None or [Entry]:
     if entries is None:
-        entries = tuple(get_data())
-    if porcelain:
-        print = lambda *a, **k: None
-    else:
-        print = __builtins__.print
+        entries = list(get_data())
+    log = (lambda *a, **k: None) if porcelain else print
+    now = datetime.datetime.now()
+    today = now.date()
+    now_minutes = now.hour * 60 + now.minute
     if entries:
-        assert max(date for date, _, _ in entries) == entries[-1].hr_date
-        last_entry_is_today = entries[-1].hr_date == Entry.now_arrived().hr_date
+        assert len(entries) < 2 or entries[-2].date_base <= entries[-1].date_base, entries[-2:]
+        last_entry_is_today = entries[-1].is_today(today)
         if last_entry_is_today:
-            print('Last entry is today.')
+            log('Last entry is today.')
         else:
-            diff = Entry.now_arrived().date_base - entries[-1].date_base
-            print(f'Last entry is {diff} ago.')
+            diff = today - entries[-1].date_base
+            log(f'Last entry is {diff} ago.')
     else:  # there is no entry yet
-            print(f'No data found. File was empty.')
+            log(f'No data found. File was empty.')
 
     if action == 'arrive':
         if entries and entries[-1].is_unfinished():
             if args.overwrite:
-                entries[-1].set_start_now()
-                print('Changed last arrival at now.')
+                entries[-1].set_start_now(now)
+                log('Changed last arrival at now.')
             else:  # just report the error
-                return print('Oops! The last entry is unfinished. You either never quit, or used the wrong command.')
+                return log('Oops! The last entry is unfinished. You either never quit, or used the wrong command.')
         else:
-            entries = entries + (Entry.now_arrived(),)
-            print('Added a new entry, arrival now.')
+            entries.append(Entry.now_arrived(now))
+            log('Added a new entry, arrival now.')
 
     elif action == 'quit':
         if entries and entries[-1].is_unfinished():
-            entries[-1].set_finish_now()
-            print('Changed last entry, quitting now.')
+            entries[-1].set_finish_now(now)
+            log('Changed last entry, quitting now.')
         else:
             if args.overwrite:
-                entries[-1].set_finish_now()
-                print('Changed last quit at now.')
+                entries[-1].set_finish_now(now)
+                log('Changed last quit at now.')
             else:
-                return print('Oops! No unfinished entry. You either never arrived, or used the wrong command.')
+                return log('Oops! No unfinished entry. You either never arrived, or used the wrong command.')
 
     elif action == 'stats':
         outdata = {}  # used if porcelain mode is active
-        workamount = defaultdict(int)  # day -> worktime amount in minutes
-        total_worktime = 0
         if not include_today:
-            entries = list(entries)
-            while entries[-1].hr_date == Entry.now_arrived().hr_date:
-                entries.pop()
-            entries = tuple(entries)
-        for entry in entries:
-            worktime = entry.working_time
-            worktime = (worktime.hour * 60 + worktime.minute)
-            total_worktime += worktime
-            workamount[entry.hr_date] += worktime
+            lo, hi = 0, len(entries)  # entries are sorted by date: bisect the first of today
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if entries[mid].date_base < today:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            entries = entries[:lo]
+        workamount = daily_worktime(entries, now_minutes)
+        total_worktime = sum(workamount.values())
 
         outdata['nb_day'] = len(workamount)
         outdata['first_day'] = entries[0].hr_date
         outdata['last_day'] = entries[-1].hr_date
         desc_today = 'in' if include_today else 'ex'
-        print(f"Statistics on {outdata['nb_day']} worked days ({desc_today}cluding today), from {outdata['first_day']} to {outdata['last_day']}")
-        print(f"You worked a total of {minutes_to_hr(total_worktime)}.")
+        log(f"Statistics on {outdata['nb_day']} worked days ({desc_today}cluding today), from {outdata['first_day']} to {outdata['last_day']}")
+        log(f"You worked a total of {minutes_to_hr(total_worktime)}.")
         outdata['total_worktime'] = total_worktime
 
         if hours_per_day:
             optimal_worktime = int(hours_per_day * 60)
-            difftime = []  # list of deviation from hour_per_day
-            for day in workamount:
-                # print(day, workamount[day])
-                difftime.append(workamount[day] - optimal_worktime)
-            outdata['total_difftime'] = sum(difftime)
-            if outdata['total_difftime'] > 0:
-                print(f"You worked {minutes_to_hr(outdata['total_difftime'])} too much since {entries[0].hr_date}.")
-            else:
-                print(f"You have to work {minutes_to_hr(-outdata['total_difftime'])} much.")
+            outdata['total_difftime'] = total_worktime - optimal_worktime * len(workamount)
+            difftime = outdata['total_difftime']
+            log(f"You worked {minutes_to_hr(difftime)} too much since {entries[0].hr_date}." if difftime > 0 else
+                f"You have to work {minutes_to_hr(-difftime)} much.")
 
-        outdata['average_per_day'] = round(sum(workamount.values()) / len(workamount))
-        print(f"You are working an average of {minutes_to_hr(outdata['average_per_day'])} per day.")
+        outdata['average_per_day'] = round(total_worktime / len(workamount))
+        log(f"You are working an average of {minutes_to_hr(outdata['average_per_day'])} per day.")
 
         if porcelain:
             for k, v in outdata.items():
-                __builtins__.print(k, v)
+                print(k, v)
             return outdata
         else:
             return outdata
@@ -223,6 +314,15 @@ def run(action, entries:[Entry]=None, overwrite:bool=False, dry_run:bool=False,
     return entries
 
 
+def daily_worktime(entries:[Entry], now_minutes:int=None) -> dict:
+    "Return worktime amount in minutes for each day, given as date ordinal"
+    workamount = defaultdict(int)  # day ordinal -> worktime amount in minutes
+    working_minutes = Entry.working_minutes  # avoid lookup in the loop
+    for entry in entries:
+        workamount[entry.date_base.toordinal()] += working_minutes(entry, now_minutes)
+    return workamount
+
+
 def minutes_to_hr(minutes:int) -> str:
     return "{:02d}h{:02d}m".format(minutes // 60, minutes % 60)
 def datetime_time_to_minutes(time:datetime.time) -> int:
@@ -231,10 +331,13 @@ def datetime_time_to_minutes(time:datetime.time) -> int:
 
 if __name__ == '__main__':
     args = parse_cli()
-    entries = tuple(get_data(args.timefile))
+    if args.binary_cache:
+        entries = get_data_cached(args.timefile, update=not args.dry_run)
+    else:
+        entries = list(get_data(args.timefile))
     ret = run(args.action, entries, args.overwrite, args.dry_run, args.hours_per_day, args.porcelain, not args.not_today)
     if ret and not args.dry_run:
-        if isinstance(ret, tuple) and all(isinstance(e, Entry) for e in ret):
+        if isinstance(ret, list) and all(isinstance(e, Entry) for e in ret):
             set_data(ret)
         else:
             pass